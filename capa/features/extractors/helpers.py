@@ -71,7 +71,9 @@ def generate_symbols(dll, symbol):
 
 
 def all_zeros(bytez):
-    return all(b == 0 for b in builtins.bytes(bytez))
+    # count the zero bytes in C rather than comparing each byte in Python
+    bytez = builtins.bytes(bytez)
+    return bytez.count(0) == len(bytez)
 
 
 def twos_complement(val, bits):
@@ -90,7 +90,7 @@ class IdaFeatureExtractor(FeatureExtractor):
     def get_basic_blocks(self, f):
         import capa.features.extractors.ida.helpers as ida_helpers
 
-        for bb in ida_helpers.get_function_blocks(f):
+        for bb in ida_helpers.get_cached_function_blocks(f):
             yield BasicBlockHandle(bb)
 
     def extract_basic_block_features(self, f, bb):
@@ -100,7 +100,7 @@ class IdaFeatureExtractor(FeatureExtractor):
     def get_instructions(self, f, bb):
         import capa.features.extractors.ida.helpers as ida_helpers
 
-        for insn in ida_helpers.get_instructions_in_range(bb.start_ea, bb.end_ea):
+        for insn in ida_helpers.get_cached_basic_block_instructions(f, bb):
             yield InstructionHandle(insn)
 
     def extract_insn_features(self, f, bb, insn):
@@ -82,7 +82,7 @@ def bb_contains_stackstring(f, bb):
         bb (IDA BasicBlock)
     """
     count = 0
-    for insn in capa.features.extractors.ida.helpers.get_instructions_in_range(bb.start_ea, bb.end_ea):
+    for insn in capa.features.extractors.ida.helpers.get_cached_basic_block_instructions(f, bb):
         if is_mov_imm_to_stack(insn):
             count += get_printable_len(insn.Op2)
         if count > MIN_STACKSTRING_LEN:
@@ -133,9 +133,12 @@ BASIC_BLOCK_HANDLERS = (
 
 def main():
     features = []
+    # data structure shared across functions, see `IdaFeatureExtractor.get_functions`
+    ctx = {}
     for f in helpers.get_functions(skip_thunks=True, skip_libs=True):
-        for bb in idaapi.FlowChart(f, flags=idaapi.FC_PREDS):
-            features.extend(list(extract_features(f, bb)))
+        setattr(f, "ctx", ctx)
+        for bb in helpers.get_cached_function_blocks(f):
+            features.extend(extract_features(f, bb))
 
     import pprint
 
@@ -69,7 +69,7 @@ def main():
     """ """
     features = []
     for f in capa.features.extractors.ida.get_functions(skip_thunks=True, skip_libs=True):
-        features.extend(list(extract_features(f)))
+        features.extend(extract_features(f))
 
     import pprint
 
@@ -277,11 +277,32 @@ def get_insn_ops(insn, target_ops=()):
         yield op
 
 
+def get_op_segment_register(op):
+    """get the segment register used by a memory operand
+
+    x86 stores it in the high word of op_t.specval (see `segrg` in the SDK's intel.hpp).
+
+    ret:
+        register id, or None if IDA did not record one
+    """
+    reg = op.specval >> 16
+    return reg if reg else None
+
+
 def is_op_stack_var(ea, index):
     """check if operand is a stack variable"""
     return idaapi.is_stkvar(idaapi.get_flags(ea), index)
 
 
+# operand value masks by data type, see `mask_op_val`
+OP_VAL_MASKS = {
+    idaapi.dt_byte: 0xFF,
+    idaapi.dt_word: 0xFFFF,
+    idaapi.dt_dword: 0xFFFFFFFF,
+    idaapi.dt_qword: 0xFFFFFFFFFFFFFFFF,
+}
+
+
 def mask_op_val(op):
     """mask value by data type
 
@@ -293,13 +314,8 @@ def mask_op_val(op):
         insn.Op2.dtype == idaapi.dt_dword
         insn.Op2.value == 0xffffffffffffffff
     """
-    masks = {
-        idaapi.dt_byte: 0xFF,
-        idaapi.dt_word: 0xFFFF,
-        idaapi.dt_dword: 0xFFFFFFFF,
-        idaapi.dt_qword: 0xFFFFFFFFFFFFFFFF,
-    }
-    return masks.get(op.dtype, op.value) & op.value
+    value = op.value
+    return OP_VAL_MASKS.get(op.dtype, value) & value
 
 
 def is_function_recursive(f):
@@ -331,13 +347,22 @@ def is_basic_block_tight_loop(bb):
     return False
 
 
-def find_data_reference_from_insn(insn, max_depth=10):
-    """search for data reference from instruction, return address of instruction if no reference exists"""
+def find_data_reference_from_insn(insn, max_depth=10, insn_data_refs=None):
+    """search for data reference from instruction, return address of instruction if no reference exists
+
+    args:
+        insn (IDA insn_t)
+        max_depth: maximum number of nested pointers to follow
+        insn_data_refs: data references from the instruction, if already collected by the caller
+    """
     depth = 0
     ea = insn.ea
 
     while True:
-        data_refs = list(idautils.DataRefsFrom(ea))
+        if ea == insn.ea and insn_data_refs is not None:
+            data_refs = insn_data_refs
+        else:
+            data_refs = tuple(idautils.DataRefsFrom(ea))
 
         if len(data_refs) != 1:
             # break if no refs or more than one ref (assume nested pointers only have one data reference)
@@ -374,6 +399,39 @@ def get_function_blocks(f):
         yield block
 
 
+def get_cached_function_blocks(f):
+    """caching accessor to `get_function_blocks`
+
+    capa extracts function, basic block, and instruction features one function at a time,
+    so only the blocks of the most recently requested function are kept.
+
+    args:
+        f (IDA func_t): with `ctx` attribute, see `IdaFeatureExtractor.get_functions`
+    """
+    cached = f.ctx.get("function_blocks")
+    if cached is None or cached[0] != f.start_ea:
+        cached = (f.start_ea, tuple(get_function_blocks(f)))
+        f.ctx["function_blocks"] = cached
+    return cached[1]
+
+
+def get_cached_basic_block_instructions(f, bb):
+    """caching accessor to the instructions of a basic block, see `get_instructions_in_range`
+
+    basic block and instruction features for a block are extracted together,
+    so only the instructions of the most recently requested block are kept.
+
+    args:
+        f (IDA func_t): with `ctx` attribute, see `IdaFeatureExtractor.get_functions`
+        bb (IDA BasicBlock)
+    """
+    cached = f.ctx.get("basic_block_instructions")
+    if cached is None or cached[0] != bb.start_ea:
+        cached = (bb.start_ea, tuple(get_instructions_in_range(bb.start_ea, bb.end_ea)))
+        f.ctx["basic_block_instructions"] = cached
+    return cached[1]
+
+
 def is_basic_block_return(bb):
     """check if basic block is return block"""
     return bb.type == idaapi.fcb_ret
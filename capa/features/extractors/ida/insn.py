@@ -6,6 +6,8 @@
 #  is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 
+import itertools
+
 import idc
 import idaapi
 import idautils
@@ -52,27 +54,128 @@ def get_imports(ctx):
     return ctx["imports_cache"]
 
 
-def check_for_api_call(ctx, insn):
-    """check instruction for API call"""
+def get_segment_register_ids(ctx):
+    """fetch the (fs, gs) register ids for the current processor"""
+    if "segment_register_ids" not in ctx:
+        ctx["segment_register_ids"] = (idautils.procregs.fs.reg, idautils.procregs.gs.reg)
+    return ctx["segment_register_ids"]
+
+
+def get_segment(ctx, ea):
+    """caching accessor to the segment containing the given address
+
+    segment boundaries are stable during extraction, so remember each segment's range
+    and only fall back to IDA for addresses in segments not seen yet.
+    """
+    segments = ctx.setdefault("segments_cache", [])
+    for (start, end, seg) in segments:
+        if start <= ea < end:
+            return seg
+
+    seg = idaapi.getseg(ea)
+    if seg:
+        segments.append((seg.start_ea, seg.end_ea, seg))
+    return seg
+
+
+def build_insn_ctx(insn):
+    """build the per-instruction cache shared by the instruction handlers
+
+    cheap queries are computed up front, while the more expensive ones (disassembly, references)
+    are computed on first use by the `get_insn_*` accessors and stored here for the remaining handlers.
+
+    operands are walked once and bucketed by type, so handlers need not re-filter `insn.ops`.
+
+    args:
+        insn (IDA insn_t)
+    """
+    ops = {
+        idaapi.o_imm: [],
+        idaapi.o_mem: [],
+        idaapi.o_phrase: [],
+        idaapi.o_displ: [],
+    }
+    for op in capa.features.extractors.ida.helpers.get_insn_ops(insn):
+        if op.type in ops:
+            ops[op.type].append(op)
+
+    return {
+        "is_call": idaapi.is_call_insn(insn),
+        "ops_imm": ops[idaapi.o_imm],
+        "ops_mem": ops[idaapi.o_mem],
+        "ops_phrase_displ": ops[idaapi.o_phrase] + ops[idaapi.o_displ],
+    }
+
+
+def get_insn_disasm(ctx, insn):
+    if "disasm" not in ctx:
+        ctx["disasm"] = idc.GetDisasm(insn.ea)
+    return ctx["disasm"]
+
+
+def get_insn_code_refs(ctx, insn):
+    if "code_refs" not in ctx:
+        ctx["code_refs"] = tuple(idautils.CodeRefsFrom(insn.ea, False))
+    return ctx["code_refs"]
+
+
+def get_insn_data_refs(ctx, insn):
+    if "data_refs" not in ctx:
+        ctx["data_refs"] = tuple(idautils.DataRefsFrom(insn.ea))
+    return ctx["data_refs"]
+
+
+def get_insn_mem_segment_registers(ctx):
+    """fetch segment registers used by the memory operands, matching the order of `ctx["ops_mem"]`
+
+    entries are None when IDA did not record a segment register for the operand.
+    """
+    if "mem_segment_registers" not in ctx:
+        ctx["mem_segment_registers"] = tuple(
+            capa.features.extractors.ida.helpers.get_op_segment_register(op) for op in ctx["ops_mem"]
+        )
+    return ctx["mem_segment_registers"]
+
+
+def get_insn_data_reference(ctx, insn):
+    if "data_reference" not in ctx:
+        ctx["data_reference"] = capa.features.extractors.ida.helpers.find_data_reference_from_insn(
+            insn, insn_data_refs=get_insn_data_refs(ctx, insn)
+        )
+    return ctx["data_reference"]
+
+
+def check_for_api_call(f, insn, ctx):
+    """check instruction for API call
+
+    yield (dll, symbol) tuples
+    """
     if not insn.get_canon_mnem() in ("call", "jmp"):
         return
 
-    info = ()
+    info = None
     ref = insn.ea
+    imports = get_imports(f.ctx)
 
     # attempt to resolve API calls by following chained thunks to a reasonable depth
     for _ in range(THUNK_CHAIN_DEPTH_DELTA):
         # assume only one code/data ref when resolving "call" or "jmp"
         try:
-            ref = tuple(idautils.CodeRefsFrom(ref, False))[0]
+            if ref == insn.ea:
+                ref = get_insn_code_refs(ctx, insn)[0]
+            else:
+                ref = tuple(idautils.CodeRefsFrom(ref, False))[0]
         except IndexError:
             try:
                 # thunks may be marked as data refs
-                ref = tuple(idautils.DataRefsFrom(ref))[0]
+                if ref == insn.ea:
+                    ref = get_insn_data_refs(ctx, insn)[0]
+                else:
+                    ref = tuple(idautils.DataRefsFrom(ref))[0]
             except IndexError:
                 break
 
-        info = get_imports(ctx).get(ref, ())
+        info = imports.get(ref)
         if info:
             break
 
@@ -81,33 +184,34 @@ def check_for_api_call(ctx, insn):
             break
 
     if info:
-        yield "%s.%s" % (info[0], info[1])
+        yield info[0], info[1]
 
 
-def extract_insn_api_features(f, bb, insn):
+def extract_insn_api_features(f, bb, insn, ctx):
     """parse instruction API features
 
     args:
         f (IDA func_t)
         bb (IDA BasicBlock)
         insn (IDA insn_t)
+        ctx (dict): per-instruction cache, see `build_insn_ctx`
 
     example:
         call dword [0x00473038]
     """
-    for api in check_for_api_call(f.ctx, insn):
-        dll, _, symbol = api.rpartition(".")
+    for (dll, symbol) in check_for_api_call(f, insn, ctx):
         for name in capa.features.extractors.helpers.generate_symbols(dll, symbol):
             yield API(name), insn.ea
 
 
-def extract_insn_number_features(f, bb, insn):
+def extract_insn_number_features(f, bb, insn, ctx):
     """parse instruction number features
 
     args:
         f (IDA func_t)
         bb (IDA BasicBlock)
         insn (IDA insn_t)
+        ctx (dict): per-instruction cache, see `build_insn_ctx`
 
     example:
         push    3136B0h         ; dwControlCode
@@ -122,7 +226,7 @@ def extract_insn_number_features(f, bb, insn):
         #   .text:00401145 add esp, 0Ch
         return
 
-    for op in capa.features.extractors.ida.helpers.get_insn_ops(insn, target_ops=(idaapi.o_imm, idaapi.o_mem)):
+    for op in ctx["ops_imm"] + ctx["ops_mem"]:
         # skip things like:
         #   .text:00401100 shr eax, offset loc_C
         if capa.features.extractors.ida.helpers.is_op_offset(insn, op):
@@ -137,57 +241,48 @@ def extract_insn_number_features(f, bb, insn):
         yield Number(const, arch=get_arch(f.ctx)), insn.ea
 
 
-def extract_insn_bytes_features(f, bb, insn):
-    """parse referenced byte sequences
+def extract_insn_data_ref_features(f, bb, insn, ctx):
+    """parse referenced byte sequences and strings
+
+    both features are derived from the same data reference, so resolve it once.
 
     args:
         f (IDA func_t)
         bb (IDA BasicBlock)
         insn (IDA insn_t)
+        ctx (dict): per-instruction cache, see `build_insn_ctx`
 
     example:
         push    offset iid_004118d4_IShellLinkA ; riid
+        push    offset aAcr     ; "ACR  > "
     """
-    if idaapi.is_call_insn(insn):
+    ref = get_insn_data_reference(ctx, insn)
+    if ref == insn.ea:
         return
 
-    ref = capa.features.extractors.ida.helpers.find_data_reference_from_insn(insn)
-    if ref != insn.ea:
+    if not ctx["is_call"]:
         extracted_bytes = capa.features.extractors.ida.helpers.read_bytes_at(ref, MAX_BYTES_FEATURE_SIZE)
         if extracted_bytes and not capa.features.extractors.helpers.all_zeros(extracted_bytes):
             yield Bytes(extracted_bytes), insn.ea
 
+    found = capa.features.extractors.ida.helpers.find_string_at(ref)
+    if found:
+        yield String(found), insn.ea
 
-def extract_insn_string_features(f, bb, insn):
-    """parse instruction string features
 
-    args:
-        f (IDA func_t)
-        bb (IDA BasicBlock)
-        insn (IDA insn_t)
-
-    example:
-        push offset aAcr     ; "ACR  > "
-    """
-    ref = capa.features.extractors.ida.helpers.find_data_reference_from_insn(insn)
-    if ref != insn.ea:
-        found = capa.features.extractors.ida.helpers.find_string_at(ref)
-        if found:
-            yield String(found), insn.ea
-
-
-def extract_insn_offset_features(f, bb, insn):
+def extract_insn_offset_features(f, bb, insn, ctx):
     """parse instruction structure offset features
 
     args:
         f (IDA func_t)
         bb (IDA BasicBlock)
         insn (IDA insn_t)
+        ctx (dict): per-instruction cache, see `build_insn_ctx`
 
     example:
         .text:0040112F cmp [esi+4], ebx
     """
-    for op in capa.features.extractors.ida.helpers.get_insn_ops(insn, target_ops=(idaapi.o_phrase, idaapi.o_displ)):
+    for op in ctx["ops_phrase_displ"]:
         if capa.features.extractors.ida.helpers.is_op_stack_var(insn.ea, op.n):
             continue
         p_info = capa.features.extractors.ida.helpers.get_op_phrase_info(op)
@@ -215,13 +310,14 @@ def contains_stack_cookie_keywords(s):
     """
     if not s:
         return False
-    s = s.strip().lower()
+    # surrounding whitespace doesn't affect substring matches, so don't bother stripping
+    s = s.lower()
     if "cookie" not in s:
         return False
-    return any(keyword in s for keyword in ("stack", "security"))
+    return "stack" in s or "security" in s
 
 
-def bb_stack_cookie_registers(bb):
+def bb_stack_cookie_registers(f, bb):
     """scan basic block for stack cookie operations
 
     yield registers ids that may have been used for stack cookie operations
@@ -247,7 +343,7 @@ def bb_stack_cookie_registers(bb):
 
     TODO: this is expensive, but necessary?...
     """
-    for insn in capa.features.extractors.ida.helpers.get_instructions_in_range(bb.start_ea, bb.end_ea):
+    for insn in capa.features.extractors.ida.helpers.get_cached_basic_block_instructions(f, bb):
         if contains_stack_cookie_keywords(idc.GetDisasm(insn.ea)):
             for op in capa.features.extractors.ida.helpers.get_insn_ops(insn, target_ops=(idaapi.o_reg,)):
                 if capa.features.extractors.ida.helpers.is_op_write(insn, op):
@@ -255,16 +351,33 @@ def bb_stack_cookie_registers(bb):
                     yield op.reg
 
 
+def get_bb_stack_cookie_registers(f, bb):
+    """caching accessor to `bb_stack_cookie_registers`, keyed by basic block start address
+
+    avoids re-scanning the basic block for each nzxor it contains
+    """
+    cache = f.ctx.setdefault("bb_stack_cookie_registers", {})
+    if bb.start_ea not in cache:
+        cache[bb.start_ea] = frozenset(bb_stack_cookie_registers(f, bb))
+    return cache[bb.start_ea]
+
+
+def get_function_entry_block(f):
+    """fetch the first basic block of a function
+
+    uses the cached flow chart, avoids re-building it for each nzxor the function contains
+    """
+    return capa.features.extractors.ida.helpers.get_cached_function_blocks(f)[0]
+
+
 def is_nzxor_stack_cookie_delta(f, bb, insn):
     """check if nzxor exists within stack cookie delta"""
     # security cookie check should use SP or BP
     if not capa.features.extractors.ida.helpers.is_frame_register(insn.Op2.reg):
         return False
 
-    f_bbs = tuple(capa.features.extractors.ida.helpers.get_function_blocks(f))
-
     # expect security cookie init in first basic block within first bytes (instructions)
-    if capa.features.extractors.ida.helpers.is_basic_block_equal(bb, f_bbs[0]) and insn.ea < (
+    if capa.features.extractors.ida.helpers.is_basic_block_equal(bb, get_function_entry_block(f)) and insn.ea < (
         bb.start_ea + SECURITY_COOKIE_BYTES_DELTA
     ):
         return True
@@ -286,7 +399,7 @@ def is_nzxor_stack_cookie(f, bb, insn):
         return True
     if is_nzxor_stack_cookie_delta(f, bb, insn):
         return True
-    stack_cookie_regs = tuple(bb_stack_cookie_registers(bb))
+    stack_cookie_regs = get_bb_stack_cookie_registers(f, bb)
     if any(op_reg in stack_cookie_regs for op_reg in (insn.Op1.reg, insn.Op2.reg)):
         # Example:
         #   mov     eax, ___security_cookie
@@ -295,7 +408,7 @@ def is_nzxor_stack_cookie(f, bb, insn):
     return False
 
 
-def extract_insn_nzxor_characteristic_features(f, bb, insn):
+def extract_insn_nzxor_characteristic_features(f, bb, insn, ctx):
     """parse instruction non-zeroing XOR instruction
 
     ignore expected non-zeroing XORs, e.g. security cookies
@@ -304,6 +417,7 @@ def extract_insn_nzxor_characteristic_features(f, bb, insn):
         f (IDA func_t)
         bb (IDA BasicBlock)
         insn (IDA insn_t)
+        ctx (dict): per-instruction cache, see `build_insn_ctx`
     """
     if insn.itype not in (idaapi.NN_xor, idaapi.NN_xorpd, idaapi.NN_xorps, idaapi.NN_pxor):
         return
@@ -314,18 +428,38 @@ def extract_insn_nzxor_characteristic_features(f, bb, insn):
     yield Characteristic("nzxor"), insn.ea
 
 
-def extract_insn_mnemonic_features(f, bb, insn):
+def extract_insn_mnemonic_features(f, bb, insn, ctx):
     """parse instruction mnemonic features
 
     args:
         f (IDA func_t)
         bb (IDA BasicBlock)
         insn (IDA insn_t)
+        ctx (dict): per-instruction cache, see `build_insn_ctx`
     """
     yield Mnemonic(insn.get_canon_mnem()), insn.ea
 
 
-def extract_insn_peb_access_characteristic_features(f, bb, insn):
+def check_for_peb_access(f, insn, ctx):
+    """check memory operands for fs:[0x30] (x86) or gs:[0x60] (x64)
+
+    this avoids rendering the disassembly text for the common case.
+
+    ret:
+        bool, or None if IDA did not record the segment register of a memory operand
+    """
+    fs, gs = get_segment_register_ids(f.ctx)
+    for (op, reg) in zip(ctx["ops_mem"], get_insn_mem_segment_registers(ctx)):
+        if reg is None:
+            return None
+        if reg == fs and op.addr == 0x30:
+            return True
+        if reg == gs and op.addr == 0x60:
+            return True
+    return False
+
+
+def extract_insn_peb_access_characteristic_features(f, bb, insn, ctx):
     """parse instruction peb access
 
     fs:[0x30] on x86, gs:[0x60] on x64
@@ -336,59 +470,72 @@ def extract_insn_peb_access_characteristic_features(f, bb, insn):
     if insn.itype not in (idaapi.NN_push, idaapi.NN_mov):
         return
 
-    if all(map(lambda op: op.type != idaapi.o_mem, insn.ops)):
+    if not ctx["ops_mem"]:
         # try to optimize for only memory references
         return
 
-    disasm = idc.GetDisasm(insn.ea)
+    found = check_for_peb_access(f, insn, ctx)
+    if found is None:
+        disasm = get_insn_disasm(ctx, insn)
+        found = " fs:30h" in disasm or " gs:60h" in disasm
 
-    if " fs:30h" in disasm or " gs:60h" in disasm:
-        # TODO: replace above with proper IDA
+    if found:
         yield Characteristic("peb access"), insn.ea
 
 
-def extract_insn_segment_access_features(f, bb, insn):
+def extract_insn_segment_access_features(f, bb, insn, ctx):
     """parse instruction fs or gs access
 
     TODO:
         IDA should be able to do this...
     """
-    if all(map(lambda op: op.type != idaapi.o_mem, insn.ops)):
+    if not ctx["ops_mem"]:
         # try to optimize for only memory references
         return
 
-    disasm = idc.GetDisasm(insn.ea)
-
-    if " fs:" in disasm:
-        # TODO: replace above with proper IDA
+    regs = get_insn_mem_segment_registers(ctx)
+    if None not in regs:
+        # segment registers recorded by IDA, no need to render the disassembly
+        fs, gs = get_segment_register_ids(f.ctx)
+        is_fs_access = fs in regs
+        is_gs_access = gs in regs
+    else:
+        disasm = get_insn_disasm(ctx, insn)
+        is_fs_access = " fs:" in disasm
+        is_gs_access = " gs:" in disasm
+
+    if is_fs_access:
         yield Characteristic("fs access"), insn.ea
 
-    if " gs:" in disasm:
-        # TODO: replace above with proper IDA
+    if is_gs_access:
         yield Characteristic("gs access"), insn.ea
 
 
-def extract_insn_cross_section_cflow(f, bb, insn):
+def extract_insn_cross_section_cflow(f, bb, insn, ctx):
     """inspect the instruction for a CALL or JMP that crosses section boundaries
 
     args:
         f (IDA func_t)
         bb (IDA BasicBlock)
         insn (IDA insn_t)
+        ctx (dict): per-instruction cache, see `build_insn_ctx`
     """
-    for ref in idautils.CodeRefsFrom(insn.ea, False):
-        if ref in get_imports(f.ctx).keys():
+    imports = get_imports(f.ctx)
+    insn_seg = get_segment(f.ctx, insn.ea)
+    for ref in get_insn_code_refs(ctx, insn):
+        if ref in imports:
             # ignore API calls
             continue
-        if not idaapi.getseg(ref):
+        ref_seg = get_segment(f.ctx, ref)
+        if not ref_seg:
             # handle IDA API bug
             continue
-        if idaapi.getseg(ref) == idaapi.getseg(insn.ea):
+        if ref_seg == insn_seg:
             continue
         yield Characteristic("cross section flow"), insn.ea
 
 
-def extract_function_calls_from(f, bb, insn):
+def extract_function_calls_from(f, bb, insn, ctx):
     """extract functions calls from features
 
     most relevant at the function scope, however, its most efficient to extract at the instruction scope
@@ -397,13 +544,14 @@ def extract_function_calls_from(f, bb, insn):
         f (IDA func_t)
         bb (IDA BasicBlock)
         insn (IDA insn_t)
+        ctx (dict): per-instruction cache, see `build_insn_ctx`
     """
-    if idaapi.is_call_insn(insn):
-        for ref in idautils.CodeRefsFrom(insn.ea, False):
+    if ctx["is_call"]:
+        for ref in get_insn_code_refs(ctx, insn):
             yield Characteristic("calls from"), ref
 
 
-def extract_function_indirect_call_characteristic_features(f, bb, insn):
+def extract_function_indirect_call_characteristic_features(f, bb, insn, ctx):
     """extract indirect function calls (e.g., call eax or call dword ptr [edx+4])
     does not include calls like => call ds:dword_ABD4974
 
@@ -414,47 +562,86 @@ def extract_function_indirect_call_characteristic_features(f, bb, insn):
         f (IDA func_t)
         bb (IDA BasicBlock)
         insn (IDA insn_t)
+        ctx (dict): per-instruction cache, see `build_insn_ctx`
     """
-    if idaapi.is_call_insn(insn) and idc.get_operand_type(insn.ea, 0) in (idc.o_reg, idc.o_phrase, idc.o_displ):
+    if ctx["is_call"] and insn.Op1.type in (idaapi.o_reg, idaapi.o_phrase, idaapi.o_displ):
         yield Characteristic("indirect call"), insn.ea
 
 
-def extract_features(f, bb, insn):
+def extract_features(f, bb, insn, ctx=None):
     """extract instruction features
 
     args:
         f (IDA func_t)
         bb (IDA BasicBlock)
         insn (IDA insn_t)
+        ctx (dict): per-instruction cache, see `build_insn_ctx`. built here if not provided.
     """
+    if ctx is None:
+        ctx = build_insn_ctx(insn)
+
     for inst_handler in INSTRUCTION_HANDLERS:
-        for (feature, ea) in inst_handler(f, bb, insn):
-            yield feature, ea
+        # delegate directly rather than unpacking and re-yielding each (feature, ea) pair
+        yield from inst_handler(f, bb, insn, ctx)
+
+    for inst_handler in ITYPE_INSTRUCTION_HANDLERS.get(insn.itype, ()):
+        yield from inst_handler(f, bb, insn, ctx)
 
 
+# handlers invoked for every instruction
 INSTRUCTION_HANDLERS = (
     extract_insn_api_features,
     extract_insn_number_features,
-    extract_insn_bytes_features,
-    extract_insn_string_features,
+    extract_insn_data_ref_features,
     extract_insn_offset_features,
-    extract_insn_nzxor_characteristic_features,
     extract_insn_mnemonic_features,
-    extract_insn_peb_access_characteristic_features,
     extract_insn_cross_section_cflow,
     extract_insn_segment_access_features,
     extract_function_calls_from,
     extract_function_indirect_call_characteristic_features,
 )
 
+# handlers that only apply to specific instruction types, keyed by insn.itype
+ITYPE_INSTRUCTION_HANDLERS = {
+    idaapi.NN_xor: (extract_insn_nzxor_characteristic_features,),
+    idaapi.NN_xorpd: (extract_insn_nzxor_characteristic_features,),
+    idaapi.NN_xorps: (extract_insn_nzxor_characteristic_features,),
+    idaapi.NN_pxor: (extract_insn_nzxor_characteristic_features,),
+    idaapi.NN_push: (extract_insn_peb_access_characteristic_features,),
+    idaapi.NN_mov: (extract_insn_peb_access_characteristic_features,),
+}
+
+
+def extract_function_insn_features(f):
+    """extract instruction features from all instructions in a function
+
+    each function is an independent unit of work; note that IDA APIs must be called from the main thread.
+
+    args:
+        f (IDA func_t): with `ctx` attribute, see `IdaFeatureExtractor.get_functions`
+
+    returns:
+        List[Tuple[Feature, int]]
+    """
+    features = []
+    for bb in capa.features.extractors.ida.helpers.get_cached_function_blocks(f):
+        for insn in capa.features.extractors.ida.helpers.get_cached_basic_block_instructions(f, bb):
+            insn_ctx = build_insn_ctx(insn)
+            features.extend(extract_features(f, bb, insn, insn_ctx))
+    return features
+
 
 def main():
     """ """
-    features = []
-    for f in capa.features.extractors.ida.helpers.get_functions(skip_thunks=True, skip_libs=True):
-        for bb in idaapi.FlowChart(f, flags=idaapi.FC_PREDS):
-            for insn in capa.features.extractors.ida.helpers.get_instructions_in_range(bb.start_ea, bb.end_ea):
-                features.extend(list(extract_features(f, bb, insn)))
+    # data structure shared across functions, see `IdaFeatureExtractor.get_functions`
+    ctx = {}
+
+    def get_functions():
+        for f in capa.features.extractors.ida.helpers.get_functions(skip_thunks=True, skip_libs=True):
+            setattr(f, "ctx", ctx)
+            yield f
+
+    features = list(itertools.chain.from_iterable(map(extract_function_insn_features, get_functions())))
 
     import pprint
 
@@ -11,6 +11,23 @@ from PyQt5.QtCore import Qt
 from capa.ida.plugin.model import CapaExplorerDataModel
 
 
+def connect_accept_cache_invalidation(model, slot):
+    """connect source model signals that may change filter results to the given slot
+
+    @param model: QAbstractItemModel
+    @param slot: callable
+    """
+    for signal in (
+        model.dataChanged,
+        model.layoutChanged,
+        model.modelReset,
+        model.rowsInserted,
+        model.rowsRemoved,
+        model.rowsMoved,
+    ):
+        signal.connect(slot)
+
+
 class CapaExplorerRangeProxyModel(QtCore.QSortFilterProxyModel):
     """filter results based on virtual address range as seen by IDA
 
@@ -25,6 +42,54 @@ class CapaExplorerRangeProxyModel(QtCore.QSortFilterProxyModel):
         super(CapaExplorerRangeProxyModel, self).__init__(parent)
         self.min_ea = None
         self.max_ea = None
+        # memoize filter_accepts_row_self across a single filter pass, see slot_clear_accept_cache
+        self._accept_cache = {}
+        # virtual address str -> int, used when sorting
+        self._va_cache = {}
+
+    def setSourceModel(self, model):
+        """set source model, clearing cached filter results whenever the source changes
+
+        our slot is connected before calling the parent implementation so that it runs before the proxy
+        re-filters in response to the same signal
+
+        @param model: QAbstractItemModel
+        """
+        connect_accept_cache_invalidation(model, self.slot_clear_accept_cache)
+        model.modelReset.connect(self.slot_clear_va_cache)
+        super(CapaExplorerRangeProxyModel, self).setSourceModel(model)
+
+    def slot_clear_accept_cache(self, *args):
+        """clear cached filter results"""
+        self._accept_cache.clear()
+
+    def slot_clear_va_cache(self):
+        """clear cached virtual address conversions
+
+        entries are keyed by the virtual address str so they never go stale; clear to bound memory use
+        """
+        self._va_cache.clear()
+
+    def get_va(self, data):
+        """convert virtual address str to int, caching the result
+
+        @param data: virtual address str
+        """
+        ea = self._va_cache.get(data)
+        if ea is None:
+            ea = int(data, 16)
+            self._va_cache[data] = ea
+        return ea
+
+    def invalidate(self):
+        """invalidate sorting and filtering"""
+        self.slot_clear_accept_cache()
+        super(CapaExplorerRangeProxyModel, self).invalidate()
+
+    def invalidateFilter(self):
+        """invalidate filtering"""
+        self.slot_clear_accept_cache()
+        super(CapaExplorerRangeProxyModel, self).invalidateFilter()
 
     def lessThan(self, left, right):
         """return True if left item is less than right item, else False
@@ -42,7 +107,7 @@ class CapaExplorerRangeProxyModel(QtCore.QSortFilterProxyModel):
             and left.column() == right.column()
         ):
             # convert virtual address before compare
-            return int(ldata, 16) < int(rdata, 16)
+            return self.get_va(ldata) < self.get_va(rdata)
         else:
             # compare as lowercase
             return ldata.lower() < rdata.lower()
@@ -71,17 +136,23 @@ class CapaExplorerRangeProxyModel(QtCore.QSortFilterProxyModel):
     def index_has_accepted_children(self, row, parent):
         """return True if parent has one or more children that match filter, else False
 
+        walk the subtree iteratively; trees may be deep and this is invoked for each row
+
         @param row: row number
         @param parent: QModelIndex of parent
         """
-        model_index = self.sourceModel().index(row, 0, parent)
+        source_model = self.sourceModel()
+        stack = [source_model.index(row, 0, parent)]
+
+        while stack:
+            model_index = stack.pop()
+            if not model_index.isValid():
+                continue
 
-        if model_index.isValid():
-            for idx in range(self.sourceModel().rowCount(model_index)):
+            for idx in range(source_model.rowCount(model_index)):
                 if self.filter_accepts_row_self(idx, model_index):
                     return True
-                if self.index_has_accepted_children(idx, model_index):
-                    return True
+                stack.append(source_model.index(idx, 0, model_index))
 
         return False
 
@@ -95,6 +166,17 @@ class CapaExplorerRangeProxyModel(QtCore.QSortFilterProxyModel):
         if self.min_ea is None and self.max_ea is None:
             return True
 
+        key = (parent.internalId(), row)
+        if key not in self._accept_cache:
+            self._accept_cache[key] = self.filter_accepts_row_address_range(row, parent)
+        return self._accept_cache[key]
+
+    def filter_accepts_row_address_range(self, row, parent):
+        """return True if row virtual address is within the filter range, else False
+
+        @param row: row number
+        @param parent: QModelIndex of parent
+        """
         index = self.sourceModel().index(row, 0, parent)
         data = index.internalPointer().data(CapaExplorerDataModel.COLUMN_INDEX_VIRTUAL_ADDRESS)
 
@@ -148,6 +230,33 @@ class CapaExplorerSearchProxyModel(QtCore.QSortFilterProxyModel):
         super(CapaExplorerSearchProxyModel, self).__init__(parent)
         self.query = ""
         self.setFilterKeyColumn(-1)  # all columns
+        # memoize filter_accepts_row_self across a single filter pass, see slot_clear_accept_cache
+        self._accept_cache = {}
+
+    def setSourceModel(self, model):
+        """set source model, clearing cached filter results whenever the source changes
+
+        our slot is connected before calling the parent implementation so that it runs before the proxy
+        re-filters in response to the same signal
+
+        @param model: QAbstractItemModel
+        """
+        connect_accept_cache_invalidation(model, self.slot_clear_accept_cache)
+        super(CapaExplorerSearchProxyModel, self).setSourceModel(model)
+
+    def slot_clear_accept_cache(self, *args):
+        """clear cached filter results"""
+        self._accept_cache.clear()
+
+    def invalidate(self):
+        """invalidate sorting and filtering"""
+        self.slot_clear_accept_cache()
+        super(CapaExplorerSearchProxyModel, self).invalidate()
+
+    def invalidateFilter(self):
+        """invalidate filtering"""
+        self.slot_clear_accept_cache()
+        super(CapaExplorerSearchProxyModel, self).invalidateFilter()
 
     def filterAcceptsRow(self, row, parent):
         """true if the item in the row indicated by the given row and parent
@@ -178,14 +287,17 @@ class CapaExplorerSearchProxyModel(QtCore.QSortFilterProxyModel):
     def index_has_accepted_children(self, row, parent):
         """returns True if the given row or its children should be accepted"""
         source_model = self.sourceModel()
-        model_index = source_model.index(row, 0, parent)
+        stack = [source_model.index(row, 0, parent)]
+
+        while stack:
+            model_index = stack.pop()
+            if not model_index.isValid():
+                continue
 
-        if model_index.isValid():
             for idx in range(source_model.rowCount(model_index)):
                 if self.filter_accepts_row_self(idx, model_index):
                     return True
-                if self.index_has_accepted_children(idx, model_index):
-                    return True
+                stack.append(source_model.index(idx, 0, model_index))
 
         return False
 
@@ -194,6 +306,15 @@ class CapaExplorerSearchProxyModel(QtCore.QSortFilterProxyModel):
         if self.query == "":
             return True
 
+        # our source is a proxy model, whose indexes share an internalId with their siblings,
+        # so (parent.internalId(), row) does not uniquely identify a row here
+        key = QtCore.QPersistentModelIndex(self.sourceModel().index(row, 0, parent))
+        if key not in self._accept_cache:
+            self._accept_cache[key] = self.filter_accepts_row_query(row, parent)
+        return self._accept_cache[key]
+
+    def filter_accepts_row_query(self, row, parent):
+        """returns True if the text of the given row matches the query"""
         source_model = self.sourceModel()
 
         for column in (
@@ -663,14 +663,16 @@ def handle_common_args(args):
       args (argparse.Namespace): parsed arguments that included at least `install_common_args` args.
     """
     if args.quiet:
-        logging.basicConfig(level=logging.WARNING)
-        logging.getLogger().setLevel(logging.WARNING)
+        level = logging.WARNING
     elif args.debug:
-        logging.basicConfig(level=logging.DEBUG)
-        logging.getLogger().setLevel(logging.DEBUG)
+        level = logging.DEBUG
     else:
-        logging.basicConfig(level=logging.INFO)
-        logging.getLogger().setLevel(logging.INFO)
+        level = logging.INFO
+
+    # basicConfig does nothing once the root logger has handlers, such as on subsequent calls,
+    # so set the level explicitly, too.
+    logging.basicConfig(level=level)
+    logging.getLogger().setLevel(level)
 
     # disable vivisect-related logging, it's verbose and not relevant for capa users
     set_vivisect_log_level(logging.CRITICAL)
@@ -680,7 +682,12 @@ def handle_common_args(args):
     # https://stackoverflow.com/a/3259271/87207
     import codecs
 
-    codecs.register(lambda name: codecs.lookup("utf-8") if name == "cp65001" else None)
+    try:
+        codecs.lookup("cp65001")
+    except LookupError:
+        # only register the search function when it's needed, and then only once,
+        # since every registered function is consulted on each uncached codec lookup.
+        codecs.register(lambda name: codecs.lookup("utf-8") if name == "cp65001" else None)
 
     if args.color == "always":
         colorama.init(strip=False)
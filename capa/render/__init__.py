@@ -262,3 +262,44 @@ def render_json(meta, rules, capabilities):
         cls=CapaJsonObjectEncoder,
         sort_keys=True,
     )
+
+
+def convert_key_to_json_compatible(key):
+    """convert the given dictionary key into the string that it is encoded as in JSON"""
+    if isinstance(key, str):
+        return key
+    elif key is True:
+        return "true"
+    elif key is False:
+        return "false"
+    elif key is None:
+        return "null"
+    else:
+        # such as an integer address
+        return str(key)
+
+
+def convert_to_json_compatible(obj):
+    """
+    convert the given result document into the structure that you'd get from decoding its JSON encoding,
+    where dictionary keys are strings, tuples are lists, and sets are sorted lists.
+
+    this is equivalent to `json.loads(json.dumps(obj, cls=CapaJsonObjectEncoder))`,
+    but takes a single pass over the document rather than encoding and then decoding it.
+    """
+    if isinstance(obj, dict):
+        return {convert_key_to_json_compatible(k): convert_to_json_compatible(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [convert_to_json_compatible(v) for v in obj]
+    elif isinstance(obj, set):
+        return [convert_to_json_compatible(v) for v in sorted(obj)]
+    else:
+        return obj
+
+
+def render_dict(meta, rules, capabilities):
+    """
+    render the results as the JSON-compatible structure that `render_json` encodes.
+    use this rather than `json.loads(render_json(...))` when you want to work with the results as Python objects.
+    """
+    return convert_to_json_compatible(convert_capabilities_to_result_document(meta, rules, capabilities))
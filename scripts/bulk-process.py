@@ -8,8 +8,11 @@ and emit a JSON document mapping the file paths to their results.
 By default, this will use subprocesses for parallelism.
 Use `-n/--parallelism` to change the subprocess count from
  the default of current CPU count.
-Use `--no-mp` to use threads instead of processes,
- which is probably not useful unless you set `--parallelism=1`.
+Use `--no-mp` to use threads instead of processes.
+With `--parallelism=1`, samples are analyzed one at a time in the current thread,
+ without any threads or subprocesses.
+Use `--dill` to use pathos subprocesses, if the default ones fail to serialize something.
+Use `--workspace-cache` to reuse vivisect workspaces across runs over the same samples.
 
 example:
 
@@ -28,7 +31,10 @@ example:
 
 usage:
 
-    usage: bulk-process.py [-h] [-r RULES] [-d] [-q] [-n PARALLELISM] [--no-mp]
+    usage: bulk-process.py [-h] [--version] [-v] [-vv] [-d] [-q]
+                           [--color {auto,always,never}] [-r RULES]
+                           [--signature SIGNATURES] [-n PARALLELISM] [--no-mp]
+                           [--dill] [--workspace-cache WORKSPACE_CACHE]
                            input
 
     detect capabilities in programs.
@@ -36,16 +42,32 @@ usage:
     positional arguments:
       input                 Path to directory of files to recursively analyze
 
-    optional arguments:
+    options:
       -h, --help            show this help message and exit
+      --version             show program's version number and exit
+      -v, --verbose         enable verbose result document (no effect with --json)
+      -vv, --vverbose       enable very verbose result document (no effect with
+                            --json)
+      -d, --debug           enable debugging output on STDERR
+      -q, --quiet           disable all output but errors
+      --color {auto,always,never}
+                            enable ANSI color codes in results, default: only
+                            during interactive session
       -r RULES, --rules RULES
-                            Path to rule file or directory, use embedded rules by
+                            path to rule file or directory, use embedded rules by
                             default
-      -d, --debug           Enable debugging output on STDERR
-      -q, --quiet           Disable all output but errors
+      --signature SIGNATURES
+                            use the given signatures to identify library
+                            functions, file system paths to .sig/.pat files.
       -n PARALLELISM, --parallelism PARALLELISM
                             parallelism factor
       --no-mp               disable subprocesses
+      --dill                use pathos subprocesses, which serialize with dill
+                            rather than pickle
+      --workspace-cache WORKSPACE_CACHE
+                            Path to directory in which to cache vivisect
+                            workspaces across runs, such as
+                            ~/.cache/capa/workspaces
 
 Copyright (C) 2020 FireEye, Inc. All Rights Reserved.
 Licensed under the Apache License, Version 2.0 (the "License");
@@ -57,26 +79,411 @@ See the License for the specific language governing permissions and limitations
 """
 import sys
 import json
+import queue
+import pickle
+import shutil
+import hashlib
 import logging
 import os.path
 import argparse
+import tempfile
+import functools
+import itertools
+import threading
+import traceback
+import importlib.util
 import multiprocessing
-import multiprocessing.pool
+import concurrent.futures
 
 import capa
 import capa.main
 import capa.rules
 import capa.render
+import capa.version
+
+try:
+    # optional, but much faster than the json module at serializing large documents.
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger("capa")
 
+# the most samples to hand to a subprocess worker in a single task.
+# larger batches amortize the per-task overhead, while smaller batches balance skewed sample runtimes better.
+MAX_SAMPLES_PER_TASK = 8
+
+# state shared by all tasks run by a worker, set up once per worker by `init_worker`.
+# this avoids sending the (large) ruleset along with every single task.
+WORKER_RULES = None
+WORKER_SIGNATURES = None
+WORKER_ARTIFACT_DIRECTORY = None
+WORKER_WORKSPACE_CACHE = None
+
+
+def init_worker(rules, signatures, artifact_directory, workspace_cache=None):
+    """
+    prepare the current process to run `get_capa_results`.
+    invoked once per subprocess by the pool, or directly when running tasks in the current process.
+
+    args:
+      rules (capa.rules.RuleSet): the rules to match
+      signatures (List[str]): file system paths to the FLIRT signatures to apply
+      artifact_directory (Optional[str]): file system path to the directory in which to write the rendered results,
+        or None to return the rendered results directly, such as when tasks run in the current process.
+      workspace_cache (Optional[str]): file system path to the directory in which to cache vivisect workspaces,
+        or None to not cache them.
+    """
+    global WORKER_RULES
+    global WORKER_SIGNATURES
+    global WORKER_ARTIFACT_DIRECTORY
+    global WORKER_WORKSPACE_CACHE
+    WORKER_RULES = rules
+    WORKER_SIGNATURES = signatures
+    WORKER_ARTIFACT_DIRECTORY = artifact_directory
+    WORKER_WORKSPACE_CACHE = workspace_cache
+
+
+def init_worker_from_file(rules_path, signatures, artifact_directory, workspace_cache=None, log_level=logging.INFO):
+    """
+    like `init_worker`, but load the rules from the given file, as pickled by `save_rules`.
+
+    otherwise, the rules would be pickled again for each subprocess that's started,
+    while this way we pay for pickling them once, and each subprocess only has to read them back.
+
+    subprocesses started from the fork server (or spawned) don't inherit the logging configuration of the parent,
+    so this also configures logging at the given level, once per subprocess.
+    """
+    logging.basicConfig(level=log_level)
+    capa.main.set_vivisect_log_level(logging.CRITICAL)
+
+    with open(rules_path, "rb") as f:
+        rules = pickle.load(f)
+
+    init_worker(rules, signatures, artifact_directory, workspace_cache)
+
+
+def save_rules(rules, path):
+    """pickle the given rules to the given file, for `init_worker_from_file`"""
+    with open(path, "wb") as f:
+        pickle.dump(rules, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def iter_samples(root):
+    """
+    recursively enumerate the file system paths of the files found under the given directory.
+    paths are generated as the directory tree is walked, so work can begin before the walk completes.
+
+    like `os.walk`, this doesn't descend into symlinked directories, and skips directories it can't read.
+    however, we use the file types cached by `os.scandir` rather than `stat`ing each entry,
+    and don't build per-directory lists of entries.
+    """
+    directories = [root]
+    while directories:
+        try:
+            entries = os.scandir(directories.pop())
+        except OSError as e:
+            logger.warning("failed to read directory: %s", str(e))
+            continue
+
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path
+
+
+def get_sample_format(path):
+    """
+    cheaply guess the format of the sample at the given path, from its file extension or first few bytes,
+    so that we don't bother dispatching files that capa won't be able to analyze anyway.
+
+    returns:
+      Optional[str]: the name of the sample file format, or None if it's not supported.
+    """
+    if path.endswith(capa.main.EXTENSIONS_SHELLCODE_32):
+        return "sc32"
+    elif path.endswith(capa.main.EXTENSIONS_SHELLCODE_64):
+        return "sc64"
+
+    try:
+        if capa.main.is_supported_file_type(path):
+            return "pe"
+    except IOError as e:
+        logger.warning("failed to read sample: %s: %s", path, str(e))
+
+    return None
+
+
+def iter_tasks(samples):
+    """
+    generate the `(format, path)` tasks for `get_capa_results` from the given sample paths,
+    skipping the samples that are not in a supported format.
+    """
+    for sample in samples:
+        format = get_sample_format(sample)
+        if format is None:
+            logger.debug("skipping unsupported file: %s", sample)
+            continue
+
+        yield (format, sample)
+
+
+class Throttle:
+    """
+    bound the number of items handed out from an iterable but not yet completed.
+    the consumer of the results calls `release` once per completed item.
+
+    this keeps `Pool.imap_unordered`, which otherwise drains its input as fast as it can,
+    from queuing up an entire (potentially huge) directory tree.
+
+    the pool's task feeder thread blocks in `iter` while the limit is reached,
+    so call `stop` before tearing down the pool early, or joining the pool waits on that thread forever.
+    """
+
+    def __init__(self, limit):
+        self.semaphore = threading.Semaphore(limit)
+        self.is_stopped = False
+
+    def iter(self, iterable):
+        for item in iterable:
+            self.semaphore.acquire()
+            if self.is_stopped:
+                return
+            yield item
+
+    def release(self):
+        self.semaphore.release()
+
+    def stop(self):
+        """stop handing out items, waking up the thread waiting on the next one, if any."""
+        self.is_stopped = True
+        self.semaphore.release()
+
+
+def imap_unordered(pool, imap, f, args, limit):
+    """
+    apply the given function f to the given args using the given pool's `imap` method, yielding results as they complete,
+    while having at most `limit` args handed out to the pool at once.
+
+    closes and joins the pool once all the results are consumed, or, when the consumer bails early,
+    terminates it without waiting on the pending tasks.
+    """
+    throttle = Throttle(limit)
+    is_complete = False
+    try:
+        for result in imap(f, throttle.iter(args)):
+            throttle.release()
+            yield result
+        is_complete = True
+    finally:
+        if is_complete:
+            pool.close()
+        else:
+            # such as when the consumer bails, due to a closed output pipe or ctrl-c.
+            # unblock the task feeder so the pool can shut down, and don't wait on pending tasks.
+            throttle.stop()
+            pool.terminate()
+        pool.join()
+
+
+def iter_batches(iterable, size):
+    """generate lists of up to the given number of consecutive items from the given iterable"""
+    iterable = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterable, size))
+        if not batch:
+            return
+        yield batch
+
+
+# modules that the worker subprocesses need, imported once by the fork server rather than by each worker.
+# this includes the vivisect backend, which capa.main only imports once it's asked for an extractor,
+# and the file format parsers, which vivisect only imports once it loads a file.
+WORKER_PRELOAD_MODULES = [
+    "capa",
+    "capa.main",
+    "capa.rules",
+    "capa.render",
+    "capa.features.extractors.viv",
+    "vivisect.parsers.pe",
+    "vivisect.parsers.blob",
+]
+
+
+def get_multiprocessing_context():
+    """
+    select how worker subprocesses are started.
+
+    on POSIX, use a fork server that imports capa once up front,
+    so that each worker is a cheap fork of it rather than a fresh interpreter that re-imports everything.
+    Windows only supports spawning fresh interpreters.
+    """
+    if sys.platform == "win32":
+        return multiprocessing.get_context("spawn")
+
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload(WORKER_PRELOAD_MODULES)
+    return ctx
+
+
+def get_vivisect_version():
+    import vivisect
+
+    try:
+        return vivisect.verstring
+    except AttributeError:
+        # older releases don't expose their version, so ask the installed distribution.
+        import pkg_resources
+
+        return pkg_resources.get_distribution("vivisect").version
+
+
+@functools.lru_cache()
+def get_signatures_digest(signatures):
+    """
+    compute the SHA-256 over the contents of the given FLIRT signature files, in order.
+    memoized, since each worker applies the same signatures to every sample.
+
+    args:
+      signatures (Tuple[str]): file system paths to the FLIRT signatures
+    """
+    digest = hashlib.sha256()
+    for signature in signatures:
+        with open(signature, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def get_cached_extractor(path, format, signatures, cache_directory):
+    """
+    like `capa.main.get_extractor` with the vivisect backend,
+    but load the workspace from the given cache directory when this sample has been analyzed before.
+    otherwise, analyze the sample and store its workspace into the cache.
+
+    workspaces are keyed by the SHA-256 of the sample, its format, the contents of the FLIRT signatures,
+    and the capa and vivisect versions.
+    so renamed or copied samples still hit the cache,
+    while upgrading or changing the signatures does not reuse stale analysis.
+    """
+    # lazy import, like capa.main, so that we only pay for vivisect when we use it.
+    import viv_utils
+
+    import capa.features.extractors.viv
+
+    with open(path, "rb") as f:
+        sha256 = hashlib.sha256(f.read()).hexdigest()
+
+    cache_path = os.path.join(
+        cache_directory,
+        "capa-%s" % (capa.version.__version__),
+        "vivisect-%s" % (get_vivisect_version()),
+        "%s.%s.%s.viv" % (sha256, format, get_signatures_digest(tuple(signatures))),
+    )
+    if os.path.exists(cache_path):
+        logger.debug("loading cached vivisect workspace for: %s from: %s", path, cache_path)
+        try:
+            vw = viv_utils.getWorkspace(cache_path, analyze=False, should_save=False)
+        except Exception as e:
+            # such as a truncated or otherwise corrupt cache entry. we'll replace it.
+            logger.warning("failed to load cached vivisect workspace: %s: %s", cache_path, str(e))
+        else:
+            return capa.features.extractors.viv.VivisectFeatureExtractor(vw, path)
+
+    vw = capa.main.get_workspace(path, format, signatures)
+
+    # write to a temporary file and then move it into place,
+    # so that other workers analyzing the same sample never see a partially written workspace.
+    temp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+    # vivisect 1.0.3 (which we pin) saves only to the workspace's StorageName,
+    # while newer releases also accept a filename. so, point StorageName at the temporary file for the save.
+    # loading a workspace resets its StorageName to the loaded path, so the saved value doesn't matter.
+    storage_name = vw.getMeta("StorageName")
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        vw.setMeta("StorageName", temp_path)
+        vw.saveWorkspace()
+        os.replace(temp_path, cache_path)
+    except Exception as e:
+        # the analysis is still good, so carry on without caching it.
+        logger.warning("failed to cache vivisect workspace: %s: %s", cache_path, str(e))
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+    finally:
+        vw.setMeta("StorageName", storage_name)
+
+    return capa.features.extractors.viv.VivisectFeatureExtractor(vw, path)
+
+
+def orjson_default(obj):
+    """serialize the types that orjson doesn't handle itself, like `capa.render.CapaJsonObjectEncoder`"""
+    if isinstance(obj, set):
+        return list(sorted(obj))
+    raise TypeError("unexpected type: %s" % type(obj))
+
+
+def render_json(meta, rules, capabilities):
+    """
+    like `capa.render.render_json`, but use orjson when it's installed.
+
+    returns:
+      bytes: the JSON document, encoded as UTF-8.
+    """
+    if orjson is None:
+        return capa.render.render_json(meta, rules, capabilities).encode("utf-8")
+
+    # address-keyed match dictionaries require OPT_NON_STR_KEYS.
+    return orjson.dumps(
+        capa.render.convert_capabilities_to_result_document(meta, rules, capabilities),
+        default=orjson_default,
+        option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS,
+    )
+
+
+def compute_capa_results(format, path):
+    """
+    run capa against the file at the given path, using the rules provided to `init_worker`,
+    returning the "ok" result described by `get_capa_results`. errors are raised.
+    """
+    if WORKER_WORKSPACE_CACHE:
+        extractor = get_cached_extractor(path, format, WORKER_SIGNATURES, WORKER_WORKSPACE_CACHE)
+    else:
+        extractor = capa.main.get_extractor(
+            path, format, capa.main.BACKEND_VIV, WORKER_SIGNATURES, disable_progress=True
+        )
+
+    meta = capa.main.collect_metadata("", path, "", format, extractor)
+    capabilities, counts = capa.main.find_capabilities(WORKER_RULES, extractor, disable_progress=True)
+    meta["analysis"].update(counts)
+
+    document = render_json(meta, WORKER_RULES, capabilities)
+    if WORKER_ARTIFACT_DIRECTORY is None:
+        return {
+            "path": path,
+            "status": "ok",
+            "document": document,
+        }
+
+    with tempfile.NamedTemporaryFile("wb", suffix=".json", dir=WORKER_ARTIFACT_DIRECTORY, delete=False) as artifact:
+        artifact.write(document)
+
+    # this result is pickled back to the parent process, so keep it small:
+    # large payloads, like the document itself, go through the artifact file instead.
+    return {
+        "path": path,
+        "status": "ok",
+        "artifact": artifact.name,
+    }
+
 
 def get_capa_results(args):
     """
-    run capa against the file at the given path, using the given rules.
+    run capa against the file at the given path, using the rules provided to `init_worker`.
 
     args is a tuple, containing:
-      rules (capa.rules.RuleSet): the rules to match
       format (str): the name of the sample file format
       path (str): the file system path to the sample to process
 
@@ -87,21 +494,22 @@ def get_capa_results(args):
       status (str): either "error" or "ok"
 
     when status == "error", then a human readable message is found in property "error".
-    when status == "ok", then the capa results are found in the property "ok".
-
-    the capa results are a dictionary with the following keys:
-      meta (dict): the meta analysis results
-      capabilities (dict): the matched capabilities and their result objects
+    if the error was unexpected, such as due to a bug, then its formatted traceback is found in property "traceback".
+    when status == "ok", then the capa results, rendered as a JSON document, are found in one of the properties:
+      artifact (str): the file system path to the JSON document, when `init_worker` was given an artifact directory.
+        the caller is responsible for removing the file once it is consumed.
+        this way, we don't have to pickle the (potentially very large) results back to the parent process.
+      document (bytes): the JSON document itself, otherwise.
     """
-    rules, format, path = args
+    format, path = args
     logger.info("computing capa results for: %s", path)
     try:
-        extractor = capa.main.get_extractor(path, format, capa.main.BACKEND_VIV, args.signatures, disable_progress=True)
+        return compute_capa_results(format, path)
     except capa.main.UnsupportedFormatError:
         # i'm 100% sure if multiprocessing will reliably raise exceptions across process boundaries.
         # so instead, return an object with explicit success/failure status.
         #
-        # if success, then status=ok, and results found in property "ok"
+        # if success, then status=ok, and results found in property "artifact" or "document"
         # if error, then status=error, and human readable message in property "error"
         return {
             "path": path,
@@ -115,105 +523,291 @@ def get_capa_results(args):
             "error": "unsupported runtime or Python interpreter",
         }
     except Exception as e:
+        # such as a malformed sample tripping up vivisect, or a bug in capa.
+        # the exception itself may not survive pickling, so pass along its description and traceback instead.
         return {
             "path": path,
             "status": "error",
-            "error": "unexpected error: %s" % (e),
+            "error": "unexpected error: %s: %r" % (path, e),
+            "traceback": traceback.format_exc(),
         }
 
-    meta = capa.main.collect_metadata("", path, "", format, extractor)
-    capabilities, counts = capa.main.find_capabilities(rules, extractor, disable_progress=True)
-    meta["analysis"].update(counts)
 
-    return {
-        "path": path,
-        "status": "ok",
-        "ok": {
-            "meta": meta,
-            "capabilities": capabilities,
-        },
-    }
+def get_capa_results_batch(tasks):
+    """
+    run `get_capa_results` for each of the given tasks, so that a single worker task covers multiple samples.
+
+    args:
+      tasks (List[Tuple[str, str]]): the `(format, path)` arguments to `get_capa_results`
+
+    returns:
+      List[Dict[str, Any]]: the results of `get_capa_results` for each task, in order.
+    """
+    return [get_capa_results(task) for task in tasks]
+
+
+def write_results(results, output):
+    """
+    stream the successful results from the given queue to the given binary output as a single JSON document,
+    mapping the sample paths to their results, until the queue yields None.
+
+    each sample's results are already an encoded JSON document, so we copy them verbatim,
+    rather than decoding and re-encoding them. artifact files are removed once they're written.
+
+    args:
+      results (queue.Queue): the results from `get_capa_results` with status "ok", followed by None.
+      output (BinaryIO): the stream to which to write the document.
+    """
+    output.write(b"{")
+    is_first = True
+    while True:
+        result = results.get()
+        if result is None:
+            break
+
+        if not is_first:
+            output.write(b", ")
+        is_first = False
+
+        output.write(json.dumps(result["path"]).encode("utf-8"))
+        output.write(b": ")
+        if "artifact" in result:
+            with open(result["artifact"], "rb") as artifact:
+                shutil.copyfileobj(artifact, output)
+            os.remove(result["artifact"])
+        else:
+            output.write(result["document"])
+        # let consumers of the output see each sample's results as soon as they're ready.
+        output.flush()
+    output.write(b"}\n")
+    output.flush()
 
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
 
-        parser = argparse.ArgumentParser(description="detect capabilities in programs.")
-        capa.main.install_common_args(parser, wanted={"rules", "signatures"})
-        parser.add_argument("input", type=str, help="Path to directory of files to recursively analyze")
-        parser.add_argument(
-            "-n", "--parallelism", type=int, default=multiprocessing.cpu_count(), help="parallelism factor"
-        )
-        parser.add_argument("--no-mp", action="store_true", help="disable subprocesses")
-        args = parser.parse_args(args=argv)
-        capa.main.handle_common_args(args)
-
-        if args.rules == "(embedded rules)":
-            logger.info("using default embedded rules")
-            logger.debug("detected running from source")
-            args.rules = os.path.join(os.path.dirname(__file__), "..", "rules")
-            logger.debug("default rule path (source method): %s", args.rules)
-        else:
-            logger.info("using rules path: %s", args.rules)
+    parser = argparse.ArgumentParser(description="detect capabilities in programs.")
+    capa.main.install_common_args(parser, wanted={"rules", "signatures"})
+    parser.add_argument("input", type=str, help="Path to directory of files to recursively analyze")
+    parser.add_argument("-n", "--parallelism", type=int, default=multiprocessing.cpu_count(), help="parallelism factor")
+    parser.add_argument("--no-mp", action="store_true", help="disable subprocesses")
+    parser.add_argument(
+        "--dill", action="store_true", help="use pathos subprocesses, which serialize with dill rather than pickle"
+    )
+    parser.add_argument(
+        "--workspace-cache",
+        type=str,
+        help="Path to directory in which to cache vivisect workspaces across runs, such as ~/.cache/capa/workspaces",
+    )
+    args = parser.parse_args(args=argv)
+    capa.main.handle_common_args(args)
+
+    # check for pathos up front, rather than failing once we're ready to start the pool.
+    if args.dill and importlib.util.find_spec("pathos") is None:
+        logger.error("--dill requires pathos, try: pip install pathos")
+        return -1
+
+    if args.rules == "(embedded rules)":
+        logger.info("using default embedded rules")
+        logger.debug("detected running from source")
+        args.rules = os.path.join(os.path.dirname(__file__), "..", "rules")
+        logger.debug("default rule path (source method): %s", args.rules)
+    else:
+        logger.info("using rules path: %s", args.rules)
 
+    try:
+        rules = capa.main.get_rules(args.rules)
+        rules = capa.rules.RuleSet(rules)
+        logger.info("successfully loaded %s rules", len(rules))
+    except (IOError, capa.rules.InvalidRule, capa.rules.InvalidRuleSet) as e:
+        logger.error("%s", str(e))
+        return -1
+
+    signatures = args.signatures
+    workspace_cache = os.path.expanduser(args.workspace_cache) if args.workspace_cache else None
+    # workers write their results here, and we remove the whole directory once we're done.
+    artifact_directory = tempfile.mkdtemp(prefix="capa-bulk-")
+
+    def pmap(f, args, parallelism=multiprocessing.cpu_count()):
+        """apply the given function f to the given args using subprocesses, yielding results as they complete"""
+        args = iter(args)
+        rules_path = os.path.join(artifact_directory, "rules.pickle")
+        save_rules(rules, rules_path)
+        initargs = (rules_path, signatures, artifact_directory, workspace_cache, logging.getLogger().level)
+
+        if sys.version_info < (3, 7):
+            # ProcessPoolExecutor only accepts `mp_context` and `initializer` as of Python 3.7.
+            pool = get_multiprocessing_context().Pool(parallelism, initializer=init_worker_from_file, initargs=initargs)
+            yield from imap_unordered(pool, pool.imap_unordered, f, args, 2 * parallelism)
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=parallelism,
+            mp_context=get_multiprocessing_context(),
+            initializer=init_worker_from_file,
+            initargs=initargs,
+        ) as executor:
+            # keep each worker busy with a task plus one queued up behind it, and no more,
+            # so we don't enumerate (and queue up) more of the inputs than necessary.
+            inflight = {executor.submit(f, arg) for arg in itertools.islice(args, 2 * parallelism)}
+            while inflight:
+                done, inflight = concurrent.futures.wait(inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                # refill the window before handing results back, so workers don't idle while they're consumed.
+                inflight.update(executor.submit(f, arg) for arg in itertools.islice(args, len(done)))
+
+                # results carry their sample path, so we don't need them in order
+                for future in done:
+                    yield future.result()
+
+    def dmap(f, args, parallelism=multiprocessing.cpu_count()):
+        """
+        apply the given function f to the given args using pathos' subprocesses, yielding results as they complete.
+        pathos serializes with dill, which handles more than pickle, such as closures, lambdas, and vivisect objects.
+        """
+        # lazy import, since pathos is optional. we check that it's available before getting here.
+        import pathos.multiprocessing
+
+        rules_path = os.path.join(artifact_directory, "rules.pickle")
+        save_rules(rules, rules_path)
+        pool = pathos.multiprocessing.ProcessPool(
+            nodes=parallelism,
+            initializer=init_worker_from_file,
+            initargs=(rules_path, signatures, artifact_directory, workspace_cache, logging.getLogger().level),
+        )
         try:
-            rules = capa.main.get_rules(args.rules)
-            rules = capa.rules.RuleSet(rules)
-            logger.info("successfully loaded %s rules", len(rules))
-        except (IOError, capa.rules.InvalidRule, capa.rules.InvalidRuleSet) as e:
-            logger.error("%s", str(e))
-            return -1
-
-        samples = []
-        for (base, directories, files) in os.walk(args.input):
-            for file in files:
-                samples.append(os.path.join(base, file))
-
-        def pmap(f, args, parallelism=multiprocessing.cpu_count()):
-            """apply the given function f to the given args using subprocesses"""
-            return multiprocessing.Pool(parallelism).imap(f, args)
-
-        def tmap(f, args, parallelism=multiprocessing.cpu_count()):
-            """apply the given function f to the given args using threads"""
-            return multiprocessing.pool.ThreadPool(parallelism).imap(f, args)
-
-        def map(f, args, parallelism=None):
-            """apply the given function f to the given args in the current thread"""
-            for arg in args:
-                yield f(arg)
-
-        if args.no_mp:
-            if args.parallelism == 1:
-                logger.debug("using current thread mapper")
-                mapper = map
-            else:
-                logger.debug("using threading mapper")
-                mapper = tmap
+            # results carry their sample path, so we don't need them in order
+            yield from imap_unordered(pool, pool.uimap, f, args, 2 * parallelism)
+        finally:
+            pool.clear()
+
+    def tmap(f, args, parallelism=multiprocessing.cpu_count()):
+        """apply the given function f to the given args using threads, yielding results as they complete"""
+        # the task queue is bounded, so the producer blocks once each worker has a task queued up behind it,
+        # rather than enumerating (and buffering) the entire input up front.
+        tasks = queue.Queue(maxsize=2 * parallelism)
+        results = queue.Queue()
+        done = object()
+
+        def produce():
+            try:
+                for arg in args:
+                    tasks.put(arg)
+            finally:
+                # always tell the workers to stop, so the consumer doesn't wait on them forever.
+                for _ in range(parallelism):
+                    tasks.put(done)
+
+        def work():
+            while True:
+                arg = tasks.get()
+                if arg is done:
+                    results.put(done)
+                    return
+
+                try:
+                    results.put((True, f(arg)))
+                except Exception as e:
+                    results.put((False, e))
+
+        # vivisect lazily imports its file format parsers, checking `sys.modules` before taking the import lock,
+        # so one thread may pick up a parser module that another thread is still initializing.
+        # therefore, import them before starting any threads.
+        import vivisect.parsers.pe
+        import vivisect.parsers.blob
+
+        # daemon threads, so that we don't wait for pending tasks if the consumer bails.
+        threads = [threading.Thread(target=produce, daemon=True)]
+        threads.extend(threading.Thread(target=work, daemon=True) for _ in range(parallelism))
+        for thread in threads:
+            thread.start()
+
+        remaining = parallelism
+        while remaining:
+            result = results.get()
+            if result is done:
+                remaining -= 1
+                continue
+
+            is_ok, value = result
+            if not is_ok:
+                raise value
+            yield value
+
+    def map(f, args, parallelism=None):
+        """apply the given function f to the given args in the current thread"""
+        for arg in args:
+            yield f(arg)
+
+    # peek at the first few tasks, leaving the rest of the directory tree to be walked lazily.
+    # this is enough to tell if there are too few samples to bother with a pool, or to bother batching them.
+    tasks = iter_tasks(iter_samples(args.input))
+    head = list(itertools.islice(tasks, 4 * max(1, args.parallelism) * MAX_SAMPLES_PER_TASK))
+    tasks = itertools.chain(head, tasks)
+
+    # tasks run in the current process don't have any per-task overhead to amortize.
+    samples_per_task = 1
+
+    if args.parallelism <= 1 or len(head) <= 2:
+        # starting up a pool (and pickling rules into it) would cost more than it saves.
+        logger.debug("using current thread mapper")
+        mapper = map
+    elif args.no_mp:
+        logger.debug("using threading mapper")
+        mapper = tmap
+    else:
+        if args.dill:
+            logger.debug("using pathos process mapper")
+            mapper = dmap
         else:
             logger.debug("using process mapper")
             mapper = pmap
-
-        results = {}
-        for result in mapper(
-            get_capa_results, [(rules, "pe", sample) for sample in samples], parallelism=args.parallelism
-        ):
-            if result["status"] == "error":
-                logger.warning(result["error"])
-            elif result["status"] == "ok":
-                meta = result["ok"]["meta"]
-                capabilities = result["ok"]["capabilities"]
-                # our renderer expects to emit a json document for a single sample
-                # so we deserialize the json document, store it in a larger dict, and we'll subsequently re-encode.
-                results[result["path"]] = json.loads(capa.render.render_json(meta, rules, capabilities))
-            else:
-                raise ValueError("unexpected status: %s" % (result["status"]))
-
-        print(json.dumps(results))
-
-        logger.info("done.")
-
-        return 0
+        # hand each worker a few batches of samples at a time, while keeping enough batches around
+        # to balance skewed sample runtimes across workers.
+        samples_per_task = max(1, min(MAX_SAMPLES_PER_TASK, len(head) // (4 * args.parallelism)))
+        logger.debug("using %d samples per task", samples_per_task)
+
+    # tasks run in the current process (threads, or no parallelism) share these.
+    # their results don't have to cross a process boundary, so they're handed back directly.
+    init_worker(rules, signatures, None, workspace_cache)
+
+    # the mappers are lazy, so no work is started until we begin consuming these.
+    batches = iter_batches(tasks, samples_per_task)
+    batch_results = mapper(get_capa_results_batch, batches, parallelism=args.parallelism)
+
+    # a writer thread streams the results to the output, so that dispatching more work never waits on it.
+    writes = queue.Queue()
+    output = sys.stdout.buffer
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            writer = executor.submit(write_results, writes, output)
+            try:
+                for result in itertools.chain.from_iterable(batch_results):
+                    if writer.done():
+                        # the writer failed, such as due to a closed output pipe. `writer.result()` raises its error.
+                        break
+
+                    if result["status"] == "error":
+                        logger.warning(result["error"])
+                        if "traceback" in result:
+                            logger.debug("%s", result["traceback"])
+                    elif result["status"] == "ok":
+                        writes.put(result)
+                    else:
+                        raise ValueError("unexpected status: %s" % (result["status"]))
+            finally:
+                writes.put(None)
+                # stop the mapper now, rather than whenever the generator happens to be collected,
+                # which may be after the interpreter has started tearing down (and waiting on) its pools.
+                batch_results.close()
+            writer.result()
+    finally:
+        shutil.rmtree(artifact_directory, ignore_errors=True)
+
+    logger.info("done.")
+
+    return 0
 
 
 if __name__ == "__main__":
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import json
 import collections
 
 import capa.main
@@ -206,8 +205,8 @@ def capa_details(file_path, output_format="dictionary"):
         capa_output = render_dictionary(doc)
     elif output_format == "json":
         # render results
-        # ...as json
-        capa_output = json.loads(capa.render.render_json(meta, rules, capabilities))
+        # ...as json-compatible python dictionary
+        capa_output = capa.render.render_dict(meta, rules, capabilities)
     elif output_format == "texttable":
         # ...as human readable text table
         capa_output = capa.render.render_default(meta, rules, capabilities)
@@ -20,3 +20,5 @@ def test_all_zeros():
     assert helpers.all_zeros(b) is True
     assert helpers.all_zeros(c) is False
     assert helpers.all_zeros(d) is False
+    assert helpers.all_zeros(b"\x00\x00\x00\x01") is False
+    assert helpers.all_zeros(bytearray(4)) is True
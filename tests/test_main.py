@@ -15,6 +15,7 @@ from fixtures import *
 import capa.main
 import capa.rules
 import capa.engine
+import capa.render
 import capa.features
 from capa.engine import *
 
@@ -301,6 +302,35 @@ def test_byte_matching(z9324d_extractor):
     assert "byte match test" in capabilities
 
 
+def test_render_dict(z9324d_extractor):
+    rules = capa.rules.RuleSet(
+        [
+            capa.rules.Rule.from_yaml(
+                textwrap.dedent(
+                    """
+                    rule:
+                        meta:
+                            name: install service
+                            scope: function
+                        features:
+                            - and:
+                                - api: advapi32.OpenSCManagerA
+                                - api: advapi32.CreateServiceA
+                                - api: advapi32.StartServiceA
+                    """
+                )
+            )
+        ]
+    )
+    capabilities, counts = capa.main.find_capabilities(rules, z9324d_extractor)
+    meta = capa.main.collect_metadata("", z9324d_extractor.path, "", "auto", z9324d_extractor)
+    meta["analysis"].update(counts)
+    assert "install service" in capabilities
+    assert capa.render.render_dict(meta, rules, capabilities) == json.loads(
+        capa.render.render_json(meta, rules, capabilities)
+    )
+
+
 def test_count_bb(z9324d_extractor):
     rules = capa.rules.RuleSet(
         [
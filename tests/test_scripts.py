@@ -0,0 +1,133 @@
+# Copyright (C) 2020 FireEye, Inc. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at: [package root]/LICENSE.txt
+# Unless required by applicable law or agreed to in writing, software distributed under the License
+#  is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+import os
+import json
+import shutil
+import textwrap
+import importlib.util
+
+import pytest
+from fixtures import *
+
+import capa.main
+import capa.rules
+import capa.render
+
+CD = os.path.dirname(__file__)
+
+
+def load_script(name):
+    """load the script with the given file name from the scripts/ directory as a module"""
+    path = os.path.join(CD, "..", "scripts", name)
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_").rpartition(".")[0], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_bulk_process_help(capsys):
+    bulk_process = load_script("bulk-process.py")
+    with pytest.raises(SystemExit) as e:
+        bulk_process.main(["--help"])
+    assert e.value.code == 0
+    assert "Path to directory of files to recursively analyze" in capsys.readouterr().out
+
+
+def test_bulk_process_argv(tmpdir, capsys):
+    bulk_process = load_script("bulk-process.py")
+
+    rules = tmpdir.mkdir("rules")
+    rules.join("test.yml").write(
+        textwrap.dedent(
+            """
+            rule:
+                meta:
+                    name: test rule
+                    scope: file
+                features:
+                    - section: .text
+            """
+        )
+    )
+    samples = tmpdir.mkdir("samples")
+    samples.join("sample.txt").write("not a PE file")
+
+    assert bulk_process.main(["-q", "-r", str(rules), str(samples)]) == 0
+    assert json.loads(capsys.readouterr().out) == {}
+
+
+def test_bulk_process_workspace_cache(tmpdir, capsys):
+    bulk_process = load_script("bulk-process.py")
+
+    rules = tmpdir.mkdir("rules")
+    rules.join("test.yml").write(
+        textwrap.dedent(
+            """
+            rule:
+                meta:
+                    name: contain loop
+                    scope: function
+                features:
+                    - characteristic: loop
+            """
+        )
+    )
+    samples = tmpdir.mkdir("samples")
+    shutil.copy(get_data_path_by_name("9324d..."), str(samples))
+    cache = tmpdir.join("cache")
+    argv = ["-q", "-r", str(rules), "--workspace-cache", str(cache), str(samples)]
+
+    # the first run analyzes the sample and caches its workspace
+    assert bulk_process.main(argv) == 0
+    cold = json.loads(capsys.readouterr().out)
+    assert len(list(cache.visit(fil="*.viv"))) == 1
+
+    # the second run loads the cached workspace
+    assert bulk_process.main(argv) == 0
+    warm = json.loads(capsys.readouterr().out)
+
+    assert len(cold) == 1
+    assert cold.keys() == warm.keys()
+    for path in cold.keys():
+        assert "contain loop" in cold[path]["rules"]
+        del cold[path]["meta"]["timestamp"]
+        del warm[path]["meta"]["timestamp"]
+    assert cold == warm
+
+
+def test_bulk_process_render_json_orjson(z9324d_extractor):
+    pytest.importorskip("orjson")
+    bulk_process = load_script("bulk-process.py")
+    assert bulk_process.orjson is not None
+
+    rules = capa.rules.RuleSet(
+        [
+            capa.rules.Rule.from_yaml(
+                textwrap.dedent(
+                    """
+                    rule:
+                        meta:
+                            name: install service
+                            scope: function
+                        features:
+                            - and:
+                                - api: advapi32.OpenSCManagerA
+                                - api: advapi32.CreateServiceA
+                                - api: advapi32.StartServiceA
+                    """
+                )
+            )
+        ]
+    )
+    capabilities, counts = capa.main.find_capabilities(rules, z9324d_extractor)
+    meta = capa.main.collect_metadata("", z9324d_extractor.path, "", "auto", z9324d_extractor)
+    meta["analysis"].update(counts)
+    assert "install service" in capabilities
+    assert json.loads(bulk_process.render_json(meta, rules, capabilities)) == json.loads(
+        capa.render.render_json(meta, rules, capabilities)
+    )